@@ -22,8 +22,11 @@ See the README for installation and usage.
 """
 import configobj
 import datetime
+import hashlib
 import logging
 import os
+import re
+import struct
 import subprocess
 import sys
 import threading
@@ -32,14 +35,14 @@ import time
 
 from enum import Enum
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import weedb
 import weewx
 import weewx.units
 import weeutil.weeutil
 
 from weeutil.weeutil import timestamp_to_string
-from weeutil.weeutil import to_float
 from weeutil.weeutil import to_int
 from weewx.engine import StdService
 from weewx.cheetahgenerator import SearchList
@@ -69,12 +72,36 @@ schema = {
     'table'         : table,
 }
 
+# The same statement text is used for every insert so that sqlite3's per-connection
+# statement cache reuses the compiled statement rather than preparing it each time.
+INSERT_EVENT_SQL = 'INSERT INTO archive (dateTime, usUnits, location, eventType, level) VALUES (?, ?, ?, ?, ?)'
+
+# A tide event in tide's csv output, e.g.:
+# Palo Alto Yacht Harbor| San Francisco Bay| California,2024-07-07,1:12 AM PDT,8.50 ft,High Tide
+# Other events (e.g., Sunrise, Moonrise) don't match.
+LINE_RE = re.compile(r'(?P<location>[^,]+),(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2}),'
+                     r'(?P<hour>\d{1,2}):(?P<minute>\d{2}) (?P<ampm>AM|PM) ?(?P<tz>[^,]*),'
+                     r'(?P<level>-?\d+(?:\.\d+)?) (?P<unit>ft|m),(?P<event>High Tide|Low Tide)$')
+
+# Timezone abbreviation (e.g., PDT) to the (fixed offset) local timezone it denotes.
+TZ_CACHE: Dict[str, datetime.tzinfo] = {}
+
 
 class EventType(Enum):
     HIGH_TIDE = 1
     LOW_TIDE  = 2
     OTHER     = 3
 
+STR_TO_EVENT_TYPE: Dict[str, EventType] = {
+    'High Tide': EventType.HIGH_TIDE,
+    'Low Tide' : EventType.LOW_TIDE,
+}
+
+INT_TO_EVENT_TYPE: Dict[int, EventType] = {
+    EventType.HIGH_TIDE.value: EventType.HIGH_TIDE,
+    EventType.LOW_TIDE.value : EventType.LOW_TIDE,
+}
+
 @dataclass
 class Event:
     dateTime : int
@@ -122,6 +149,19 @@ class XTide(StdService):
             log.error('You must delete the xtide.sdb database and restart weewx.  It contains an old schema!')
             return
 
+        # Use write-ahead logging so that the report (reader) and this service (writer) don't
+        # block each other, and only sync at checkpoints rather than on every commit.  With
+        # synchronous=NORMAL, a power loss can lose the last commit, but cannot corrupt the
+        # database (and the events are regenerated on the next poll anyway).
+        if dbmanager.connection.dbtype == 'sqlite':
+            try:
+                dbmanager.connection.execute('PRAGMA journal_mode=WAL')
+                dbmanager.connection.execute('PRAGMA synchronous=NORMAL')
+                dbmanager.connection.execute('PRAGMA temp_store=MEMORY')
+                dbmanager.connection.execute('PRAGMA cache_size=-8000')
+            except Exception as e:
+                log.info('Could not set sqlite pragmas: %s (%s)' % (e, type(e)))
+
         location    = self.xtide_config_dict.get('location', None)
         if location is None:
             log.error('location must be spcified.')
@@ -135,6 +175,17 @@ class XTide(StdService):
             events      = [],
             )
 
+        # Digest of the events in the database.  It is compared against a digest of newly
+        # fetched events to determine if the database needs to be rewritten.  The raw rows
+        # are digested directly (rather than building a dict per row).
+        try:
+            self.events_digest: str = XTide.compute_digest(dbmanager.genSql(
+                'SELECT dateTime, usUnits, location, eventType, level FROM archive ORDER BY dateTime'))
+        except Exception as e:
+            # The events will be rewritten on the first save.
+            log.error('Could not compute digest of saved events: %s (%s)' % (e, type(e)))
+            self.events_digest = ''
+
         XTidePoller.populate_tidal_events(self.cfg)
 
         log.info('location    : %s' % self.cfg.location)
@@ -166,15 +217,15 @@ class XTide(StdService):
                     return
                 # Before deleting exiting events and readding, check if
                 # anything has changed.
-                events_in_db = self.select_events()
-                if XTide.events_compare_equal(self.cfg.events, events_in_db):
+                digest = XTide.compute_digest(XTide.event_rows(self.cfg.events))
+                if digest == self.events_digest:
                     log.info('Ignoring generated tidal events as they have not changed.')
                     self.cfg.events.clear()
                     return
-                # The events have changed, got ahead and delete and re-add.
-                self.delete_all_events()
-                for event in self.cfg.events:
-                    self.save_event(XTide.convert_to_json(event))
+                # The events have changed, go ahead and replace them.
+                dbmanager = self.engine.db_binder.get_manager(self.data_binding)
+                XTide._replace_events(dbmanager, XTide.event_rows(self.cfg.events))
+                self.events_digest = digest
                 log.info('Saved %d events.' % len(self.cfg.events))
                 self.cfg.events.clear()
         except Exception as e:
@@ -183,52 +234,35 @@ class XTide(StdService):
             log.error('saveEventsToDB: %s (%s)' % (e, type(e)))
             weeutil.logger.log_traceback(log.error, "    ****  ")
 
-    def save_event(self, event) -> None:
-        """save event to database"""
-        dbmanager = self.engine.db_binder.get_manager(self.data_binding)
-        dbmanager.addRecord(event)
-
-    def delete_all_events(self) -> None:
-        try:
-           dbmanager = self.engine.db_binder.get_manager(self.data_binding)
-           try:
-               select = 'SELECT COUNT(dateTime) FROM archive'
-               log.debug('Getting count of events: %s.' % select)
-               row = dbmanager.getSql(select)
-           except Exception as e:
-               log.error('delete_all_events: %s failed with %s (%s).' % (select, e, type(e)))
-               weeutil.logger.log_traceback(log.error, "    ****  ")
-               return
-           # If there are events, delete them.
-           if row[0] != 0:
-               delete = 'DELETE FROM archive'
-               dbmanager.getSql(delete)
-        except Exception as e:
-           log.error('delete_all_events: %s failed with %s (%s).' % (delete, e, type(e)))
-           weeutil.logger.log_traceback(log.error, "    ****  ")
-
     @staticmethod
-    def events_compare_equal(events: List[Event], db_events: List[Dict[str, Any]]) -> bool:
-        if len(events) != len(db_events):
-            return False
-
-        for i in range(len(events)):
-            if events[i].dateTime != db_events[i]['dateTime'] or events[i].usUnits != db_events[i]['usUnits'] or events[i].location != db_events[i]['location'] or events[i].eventType != db_events[i]['eventType'] or events[i].level != db_events[i]['level']:
-                return False
+    def _replace_events(dbmanager: weewx.manager.Manager, rows: Iterable[Tuple[int, int, str, int, float]]) -> None:
+        """Delete all events and insert rows in a single transaction.
+
+        If anything fails, the transaction is rolled back and the old events remain.
+        """
+        with weedb.Transaction(dbmanager.connection) as cursor:
+            cursor.execute('DELETE FROM archive')
+            if dbmanager.connection.dbtype == 'sqlite':
+                cursor.executemany(INSERT_EVENT_SQL, rows)
+            else:
+                # Other weedb cursors (e.g., MySQL) don't support executemany.
+                for row in rows:
+                    cursor.execute(INSERT_EVENT_SQL, row)
 
-        return True
+    @staticmethod
+    def event_rows(events: Iterable[Event]) -> Iterator[Tuple[int, int, str, int, float]]:
+        """Generates (dateTime, usUnits, location, eventType, level) rows without building a list."""
+        return ((e.dateTime, e.usUnits, e.location, e.eventType.value, e.level) for e in events)
 
     @staticmethod
-    def convert_to_json(event) -> Dict[str, Any]:
-        log.debug('convert_to_json: start')
-        j = {}
-        j['dateTime']      = event.dateTime
-        j['usUnits']       = event.usUnits
-        j['location']      = event.location
-        j['eventType']     = event.eventType.value
-        j['level']         = event.level
-        log.debug('convert_to_json: returning: %s' % j)
-        return j
+    def compute_digest(rows: Iterable[Tuple[int, int, str, int, float]]) -> str:
+        """Returns a digest of (dateTime, usUnits, location, eventType, level) rows."""
+        h = hashlib.blake2b()
+        for row in rows:
+            location = row[2].encode('utf-8')
+            h.update(struct.pack('<qiBdI', row[0], int(row[1]), row[3], row[4], len(location)))
+            h.update(location)
+        return h.hexdigest()
 
 class XTidePoller:
     def __init__(self, cfg: Configuration):
@@ -236,108 +270,120 @@ class XTidePoller:
 
     def poll_xtide(self) -> None:
         while True:
+            succeeded = False
             try:
                 if XTidePoller.populate_tidal_events(self.cfg):
-                    log.info('XTidePoller.populate_tidal_events returned %d tidal events.' % len(self.cfg.events))
+                    succeeded = True
                 else:
                     log.info('XTidePoller.populate_tidal_events failed')
             except Exception as e:
                 log.error('poll_xtide: Encountered exception: %s (%s)' % (e, type(e)))
                 weeutil.logger.log_traceback(log.error, "    ****  ")
 
-            sleep_time = XTidePoller.time_to_next_poll()
+            sleep_time = XTidePoller.time_to_next_poll(succeeded)
             log.debug('poll_xtide: Sleeping for %f seconds.' % sleep_time)
             time.sleep(sleep_time)
 
     @staticmethod
-    def time_to_next_poll() -> float:
+    def time_to_next_poll(last_poll_succeeded: bool) -> float:
         # determine the number of seconds until midnight tonight
         now: datetime.datetime = datetime.datetime.now().astimezone()
         midnight_this_morning = now.replace(hour=0, minute=0, second=0, microsecond=0)
         midnight_tonight = midnight_this_morning + datetime.timedelta(hours=24)
-        return midnight_tonight.timestamp() - time.time()
+        seconds_to_midnight = midnight_tonight.timestamp() - time.time()
+        if not last_poll_succeeded:
+            # Retry hourly (but not past midnight).
+            return min(3600.0, seconds_to_midnight)
+        return seconds_to_midnight
 
     @staticmethod
     def populate_tidal_events(cfg: Configuration) -> bool:
+        # Don't hold the lock while tide runs; snapshot the inputs and publish the results.
         with cfg.lock:
-            try:
-                # Begin is the start of today (in current timezone)
-                now: datetime.datetime = datetime.datetime.now().astimezone()
-                begin = now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
-                end: int = to_int(begin + 24 * 3600 * cfg.days)
-                p = subprocess.Popen([cfg.prog, '-l', cfg.location, '-b', timestamp_to_string(begin), '-e', timestamp_to_string(end), '-f' 'c', '-m', 'p', '-s', '01:00'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                rc = p.returncode
-                if rc is not None:
-                    log.error("Call to tide failed: loc='%s' rc=%s" % (cfg.location, rc))
-                    return False
-                # /home/jkline/software/xtide-2.15.5/tide -l "Palo Alto Yacht Harbor" -b "2024-07-07 00:00" -e "2024-07-15 00:00" -f c -m p -s "01:00"
-                # Palo Alto Yacht Harbor| San Francisco Bay| California,2024-07-07,1:12 AM PDT,8.50 ft,High Tide
-                # Palo Alto Yacht Harbor| San Francisco Bay| California,2024-07-07,5:54 AM PDT,,Sunrise
-                # Palo Alto Yacht Harbor| San Francisco Bay| California,2024-07-07,7:24 AM PDT,,Moonrise
-                # Palo Alto Yacht Harbor| San Francisco Bay| California,2024-07-07,9:31 AM PDT,-0.64 ft,Low Tide
-                out = []
-                if p.stdout:
-                    for bytes in p.stdout:
-                        line = bytes.decode('utf-8')
-                        if line.count(',') == 4:
-                            out.append(line)
-                        else:
-                            log.info("ignoring line: %s" % line)
-                if out:
-                    log.debug('tide returned %d lines.' % len(out))
-                    cfg.events = []
-                    for line in out:
-                        line = line.replace('\n', '')
-                        cols = line.split(',')
-                        eventType  = XTidePoller.encode_event_type(cols[4])
-                        if eventType == EventType.HIGH_TIDE or eventType == EventType.LOW_TIDE:
-                            unit = cols[3].split(' ')[1]
-                            cfg.events.append(Event(
-                                dateTime  = to_int(datetime.datetime.strptime('%s %s' % (cols[1], cols[2]), '%Y-%m-%d %I:%M %p %Z').timestamp()), # 2024-07-07 8:32 PM PDT
-                                usUnits   = weewx.US if unit == 'ft' else weewx.METRIC,
-                                location  = cols[0].replace('|', ','),
-                                eventType = eventType,
-                                level     = to_float(cols[3].split(' ')[0]),
-                            ))
-                        else:
-                            log.debug('Ignoring %s event: %s' % (cols[4], line))
-                    log.debug('Fetched %d events (includes sunrise/sunset events).'  % len(out))
-                    return True
-                else:
-                    # There was no output
-                    if p.stderr:
-                        for bytes in p.stderr:
-                            line = bytes.decode('utf-8')
-                            line = line.replace('\n', '')
-                            if line.startswith('XTide Fatal Error:'):
-                                log.error(line)
-                    return False
-            except FileNotFoundError:
-                log.error('%s not found' % cfg.prog)
-                return False
-            except subprocess.CalledProcessError as cpe:
-                log.error("tide for location %s failed rc:%d %s" % (cfg.location, cpe.returncode, cpe.output))
+            location, prog, days = cfg.location, cfg.prog, cfg.days
+        try:
+            # Begin is the start of today (in current timezone)
+            now: datetime.datetime = datetime.datetime.now().astimezone()
+            begin = now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+            end: int = to_int(begin + 24 * 3600 * days)
+            # -s (step) only applies to graph/stats modes, not plain mode.  The event mask (-em)
+            # suppresses moon phase, sunrise, sunset, moonrise and moonset events.
+            p = subprocess.Popen([prog, '-l', location, '-b', timestamp_to_string(begin), '-e', timestamp_to_string(end), '-f' 'c', '-m', 'p', '-em', 'pSsMm'],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8')
+            # /home/jkline/software/xtide-2.15.5/tide -l "Palo Alto Yacht Harbor" -b "2024-07-07 00:00" -e "2024-07-15 00:00" -f c -m p -em pSsMm
+            # Palo Alto Yacht Harbor| San Francisco Bay| California,2024-07-07,1:12 AM PDT,8.50 ft,High Tide
+            # Palo Alto Yacht Harbor| San Francisco Bay| California,2024-07-07,9:31 AM PDT,-0.64 ft,Low Tide
+            # Read all of the output at once (this also waits for tide to exit).
+            stdout, stderr = p.communicate()
+            events = []
+            for line in stdout.splitlines():
+                # Only keep tide events (skip any other events tide reports).
+                m = LINE_RE.match(line)
+                if m:
+                    events.append(Event(
+                        dateTime  = XTidePoller.parse_event_time(m),
+                        usUnits   = weewx.US if m['unit'] == 'ft' else weewx.METRIC,
+                        location  = m['location'].replace('|', ','),
+                        eventType = XTidePoller.encode_event_type(m['event']),
+                        level     = float(m['level']),
+                    ))
+            rc = p.returncode
+            if rc != 0:
+                log.error("Call to tide failed: loc='%s' rc=%s" % (location, rc))
+            if events and rc == 0:
+                # Log the count here; once published, cfg.events may be cleared by saveEventsToDB.
+                log.info('XTidePoller.populate_tidal_events fetched %d tidal events.' % len(events))
+                with cfg.lock:
+                    cfg.events = events
+                return True
+            else:
+                # There was no output, or tide failed
+                for line in stderr.splitlines():
+                    if line.startswith('XTide Fatal Error:'):
+                        log.error(line)
                 return False
+        except FileNotFoundError:
+            log.error('%s not found' % prog)
+            return False
+        except ValueError as e:
+            log.error('Could not parse tide output for location %s: %s' % (location, e))
+            return False
+        except subprocess.CalledProcessError as cpe:
+            log.error("tide for location %s failed rc:%d %s" % (location, cpe.returncode, cpe.output))
+            return False
+
+    @staticmethod
+    def parse_event_time(m: re.Match) -> int:
+        """Returns the timestamp for a LINE_RE match's date (2024-07-07) and time (8:32 PM PDT).
+
+        As with strptime's %Z, the time is local time and ValueError is raised if the timezone
+        abbreviation is not the local one for that time (e.g., PDT on a UTC machine).  The local
+        offset is looked up once per abbreviation and cached in TZ_CACHE.  For the repeated hour
+        when DST ends, the abbreviation (e.g., 1:30 AM PDT vs. 1:30 AM PST) selects which
+        occurrence is meant.
+        """
+        hour = int(m['hour']) % 12 + (12 if m['ampm'] == 'PM' else 0)
+        dt = datetime.datetime(int(m['year']), int(m['month']), int(m['day']), hour, int(m['minute']))
+        tz = TZ_CACHE.get(m['tz'])
+        if tz is None:
+            # Try both occurrences (fold) of the local time; the abbreviation must be the
+            # local one for this time.
+            for fold in (0, 1):
+                tz = dt.replace(fold=fold).astimezone().tzinfo
+                if tz is not None and tz.tzname(None) == m['tz']:
+                    TZ_CACHE[m['tz']] = tz
+                    break
+            else:
+                raise ValueError("Timezone '%s' of tide event '%s' is not this machine's local timezone." % (m['tz'], m.group(0)))
+        return int(dt.replace(tzinfo=tz).timestamp())
 
     @staticmethod
     def encode_event_type(event_str: str) -> EventType:
-        match event_str:
-            case "High Tide":
-                return EventType.HIGH_TIDE
-            case "Low Tide":
-                return EventType.LOW_TIDE
-            case _:
-                return EventType.OTHER
+        return STR_TO_EVENT_TYPE.get(event_str, EventType.OTHER)
 
     @staticmethod
     def event_type_from_int(i: int) -> EventType:
-        match i:
-            case 1:
-                return EventType.HIGH_TIDE
-            case 2:
-                return EventType.LOW_TIDE
-            case _:
-                return EventType.OTHER
+        return INT_TO_EVENT_TYPE.get(i, EventType.OTHER)
 
 class XTideVariables(SearchList):
     def __init__(self, generator):
@@ -401,19 +447,20 @@ class XTideVariables(SearchList):
     @staticmethod
     def fetch_records_internal(dbm: weewx.manager.Manager, max_events: Optional[int] = None) -> List[Dict[str, Any]]:
         select = 'SELECT dateTime, usUnits, location, eventType, level FROM archive ORDER BY dateTime'
+        sqlargs: Tuple[int, ...] = ()
+        if max_events:
+            # dateTime is the primary key, so only max_events rows are read.
+            select += ' LIMIT ?'
+            sqlargs = (max_events,)
         records = []
-        event_count = 0
-        for row in dbm.genSql(select):
-                event_count += 1
-                record = {}
-
-                record['dateTime'] = row[0]
-                record['usUnits'] = row[1]
-                record['location'] = row[2]
-                record['eventType'] = XTidePoller.event_type_from_int(row[3])
-                record['level'] = row[4]
-
-                records.append(record)
+        for row in dbm.genSql(select, sqlargs):
+            records.append({
+                'dateTime' : row[0],
+                'usUnits'  : row[1],
+                'location' : row[2],
+                'eventType': XTidePoller.event_type_from_int(row[3]),
+                'level'    : row[4],
+            })
         return records
 
 if __name__ == '__main__':